@@ -1,24 +1,34 @@
 import asyncio
+import json
 import os
 import re
 import shutil
-import subprocess
+import tarfile
+import tempfile
 import time
+import zipfile
 from pathlib import Path
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Sequence
 
-import aiofiles
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command
+from aiogram.filters import Command, StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import (
     Message,
     FSInputFile,
+    BufferedInputFile,
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
     InputMediaDocument,
 )
 
+try:
+    import zstandard
+except ImportError:  # optional: image bundles fall back to .zip
+    zstandard = None
+
 # =========================
 # CONFIG
 # =========================
@@ -33,17 +43,44 @@ if allowed_env:
 
 BASE_DIR = Path(os.environ.get("PDF_BOT_BASE_DIR", "/opt/tg-pdf-bot/data")).resolve()
 BASE_DIR.mkdir(parents=True, exist_ok=True)
+SESSIONS_FILE = BASE_DIR / ".sessions.json"
 
 MAX_FILE_MB = int(os.environ.get("MAX_FILE_MB", "45"))
 MAX_FILE_BYTES = MAX_FILE_MB * 1024 * 1024
+DOWNLOAD_TIMEOUT = 300  # seconds, enough for MAX_FILE_MB on a slow link
+DOWNLOAD_CHUNK = 1024 * 1024
 SESSION_TTL = int(os.environ.get("SESSION_TTL", str(6 * 3600)))
+GC_INTERVAL = max(60, SESSION_TTL // 10)
+CPU_COUNT = os.cpu_count() or 1
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", str(4 * CPU_COUNT)))
+COMPRESS_CHUNK_PAGES = 20  # min pages per parallel gs worker
+COMPRESS_PARALLEL = os.environ.get("COMPRESS_PARALLEL", "1") != "0"
+GS_LINEARIZE = os.environ.get("GS_LINEARIZE", "1") != "0"
 
 dp = Dispatcher()
 
-# user_id -> ("action", step, payload)
-# action: "extract" | "images" | "compress"
-# step: 1 (need file index) or 2 (need param like range/dpi/preset)
-PENDING: Dict[int, Tuple[str, int, dict]] = {}
+# interactive flow; FSM data: action ("extract" | "images" | "compress"),
+# then idx/src once the file is chosen
+class Flow(StatesGroup):
+    choose_file = State()  # need file index
+    param = State()        # need param like range/dpi/preset
+
+# user_id -> last activity ts; flushed to SESSIONS_FILE by gc_loop
+_SESSION_LAST: Dict[int, int] = {}
+
+# (path, mtime_ns, size) -> page count; FIFO-evicted
+_PAGE_CACHE: Dict[Tuple[str, int, int], int] = {}
+_PAGE_CACHE_MAX = 512
+
+# user dir -> (dir mtime_ns, sorted PDFs)
+_PDFS_CACHE: Dict[str, Tuple[int, Tuple[Path, ...]]] = {}
+
+# one slot per core, shared by every external tool process (across all users)
+_CPU_SEM = asyncio.Semaphore(CPU_COUNT)
+_CPU_SEM_WAITERS = 0
+
+# user_id -> lock held while one of the user's heavy jobs runs
+_USER_LOCK: Dict[int, asyncio.Lock] = {}
 
 # =========================
 # UI
@@ -57,18 +94,24 @@ BTN_COMPRESS = "🗜 Compress"
 BTN_HELP = "ℹ️ Help"
 BTN_CANCEL = "❌ Cancel"
 
+# built once: aiogram serializes it per send and never mutates it
+_MENU_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text=BTN_LIST), KeyboardButton(text=BTN_HELP)],
+        [KeyboardButton(text=BTN_MERGE), KeyboardButton(text=BTN_CLEAR)],
+        [KeyboardButton(text=BTN_EXTRACT), KeyboardButton(text=BTN_IMAGES)],
+        [KeyboardButton(text=BTN_COMPRESS), KeyboardButton(text=BTN_CANCEL)],
+    ],
+    resize_keyboard=True,
+    is_persistent=True,
+    selective=True,
+)
+
 def menu_kb() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text=BTN_LIST), KeyboardButton(text=BTN_HELP)],
-            [KeyboardButton(text=BTN_MERGE), KeyboardButton(text=BTN_CLEAR)],
-            [KeyboardButton(text=BTN_EXTRACT), KeyboardButton(text=BTN_IMAGES)],
-            [KeyboardButton(text=BTN_COMPRESS), KeyboardButton(text=BTN_CANCEL)],
-        ],
-        resize_keyboard=True,
-        is_persistent=True,
-        selective=True,
-    )
+    return _MENU_KB
+
+BUSY_TEXT = "Server busy, try again in a minute."
+RUNNING_TEXT = "Still working on your previous request, please wait."
 
 HELP_TEXT = """PDF bot
 
@@ -109,16 +152,50 @@ def user_dir(user_id: int) -> Path:
 def now_ts() -> int:
     return int(time.time())
 
-def touch_session(d: Path) -> None:
-    (d / ".last").write_text(str(now_ts()), encoding="utf-8")
+def touch_session(user_id: int) -> None:
+    _SESSION_LAST[user_id] = now_ts()
+
+def user_lock(user_id: int) -> asyncio.Lock:
+    return _USER_LOCK.setdefault(user_id, asyncio.Lock())
+
+def prune_user_locks() -> None:
+    cutoff = now_ts() - SESSION_TTL
+    for uid, lock in list(_USER_LOCK.items()):
+        if not lock.locked() and _SESSION_LAST.get(uid, 0) < cutoff:
+            del _USER_LOCK[uid]
+
+def load_sessions() -> None:
+    try:
+        data = json.loads(SESSIONS_FILE.read_text(encoding="utf-8"))
+        _SESSION_LAST.update({int(k): int(v) for k, v in data.items()})
+    except Exception:
+        pass  # cold start: fall back to per-dir .last files
+
+def save_sessions(snapshot: Dict[int, int]) -> None:
+    tmp = SESSIONS_FILE.with_suffix(".tmp")
+    tmp.write_text(json.dumps(snapshot), encoding="utf-8")
+    tmp.replace(SESSIONS_FILE)
 
 def session_last(d: Path) -> int:
+    try:
+        last = _SESSION_LAST.get(int(d.name))
+    except ValueError:
+        last = None
+    if last is not None:
+        return last
+
+    # legacy per-dir timestamp file
     p = d / ".last"
-    if not p.exists():
-        return 0
+    if p.exists():
+        try:
+            return int(p.read_text(encoding="utf-8").strip())
+        except Exception:
+            pass
+
+    # not flushed before a crash: the dir's mtime is the best guess
     try:
-        return int(p.read_text(encoding="utf-8").strip())
-    except Exception:
+        return int(d.stat().st_mtime)
+    except OSError:
         return 0
 
 def cleanup_old_sessions() -> None:
@@ -128,71 +205,198 @@ def cleanup_old_sessions() -> None:
         last = session_last(d)
         if last and now_ts() - last > SESSION_TTL:
             shutil.rmtree(d, ignore_errors=True)
+            if d.name.isdigit():
+                _SESSION_LAST.pop(int(d.name), None)
+
+async def gc_loop() -> None:
+    while True:
+        await asyncio.sleep(GC_INTERVAL)
+        try:
+            await asyncio.to_thread(cleanup_old_sessions)
+            await asyncio.to_thread(save_sessions, dict(_SESSION_LAST))
+            prune_user_locks()
+        except Exception:
+            pass  # keep the loop alive; next pass retries
 
 # =========================
 # UTIL
 # =========================
-def run_cmd(cmd: List[str]) -> None:
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if proc.returncode != 0:
+def server_busy() -> bool:
+    return _CPU_SEM_WAITERS > MAX_QUEUE
+
+async def exec_tool(cmd: List[str]) -> Tuple[int, bytes, bytes]:
+    global _CPU_SEM_WAITERS
+    _CPU_SEM_WAITERS += 1
+    try:
+        await _CPU_SEM.acquire()
+    finally:
+        _CPU_SEM_WAITERS -= 1
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            out, err = await proc.communicate()
+        except BaseException:
+            # cancelled: don't leave the child running once its slot is freed
+            proc.kill()
+            await proc.wait()
+            raise
+    finally:
+        _CPU_SEM.release()
+    return proc.returncode, out, err
+
+async def run_cmd(cmd: List[str]) -> str:
+    returncode, out, err = await exec_tool(cmd)
+    if returncode != 0:
+        stderr = err.decode(errors="replace")
         raise RuntimeError(
-            f"Command failed: {' '.join(cmd)}\n\nSTDERR:\n{proc.stderr[-4000:]}"
+            f"Command failed: {' '.join(cmd)}\n\nSTDERR:\n{stderr[-4000:]}"
         )
+    return out.decode(errors="replace")
+
+async def run_cmds(cmds: List[List[str]]) -> None:
+    # parallel fan-out; on the first failure (or our own cancellation) the
+    # remaining runs are cancelled, which kills their processes, before raising
+    if not cmds:
+        return
+    tasks = [asyncio.ensure_future(run_cmd(cmd)) for cmd in cmds]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for t in tasks:
+        if not t.cancelled() and t.exception() is not None:
+            raise t.exception()
 
 def safe_name(name: str) -> str:
     name = name.strip()
     name = re.sub(r"[^A-Za-z0-9._-]+", "_", name)
     return name or "file.pdf"
 
-def list_pdfs(d: Path) -> List[Path]:
-    return sorted([p for p in d.iterdir() if p.is_file() and p.suffix.lower() == ".pdf"])
-
-def pdf_page_count(pdf: Path) -> int:
-    proc = subprocess.run(["pdfinfo", str(pdf)], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if proc.returncode != 0:
-        raise RuntimeError(f"pdfinfo failed:\n{proc.stderr[-2000:]}")
-    m = re.search(r"^Pages:\s+(\d+)\s*$", proc.stdout, re.MULTILINE)
+def list_pdfs(d: Path) -> Tuple[Path, ...]:
+    key = str(d)
+    mtime = d.stat().st_mtime_ns
+    cached = _PDFS_CACHE.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    pdfs = tuple(sorted(p for p in d.iterdir() if p.is_file() and p.suffix.lower() == ".pdf"))
+    _PDFS_CACHE[key] = (mtime, pdfs)
+    return pdfs
+
+def forget_pdfs(d: Path) -> None:
+    # explicit drop for writers: dir mtime may be too coarse to notice them
+    _PDFS_CACHE.pop(str(d), None)
+
+async def pdf_page_count(pdf: Path) -> int:
+    st = pdf.stat()
+    key = (str(pdf), st.st_mtime_ns, st.st_size)
+    if key in _PAGE_CACHE:
+        return _PAGE_CACHE[key]
+
+    returncode, out, err = await exec_tool(["pdfinfo", str(pdf)])
+    if returncode != 0:
+        raise RuntimeError(f"pdfinfo failed:\n{err.decode(errors='replace')[-2000:]}")
+    m = re.search(r"^Pages:\s+(\d+)\s*$", out.decode(errors="replace"), re.MULTILINE)
     if not m:
         raise RuntimeError("Could not read page count from pdfinfo output")
-    return int(m.group(1))
+    pages = int(m.group(1))
+
+    if len(_PAGE_CACHE) >= _PAGE_CACHE_MAX:
+        del _PAGE_CACHE[next(iter(_PAGE_CACHE))]
+    _PAGE_CACHE[key] = pages
+    return pages
+
+def forget_page_counts(d: Path) -> None:
+    prefix = str(d) + os.sep
+    for key in [k for k in _PAGE_CACHE if k[0].startswith(prefix)]:
+        _PAGE_CACHE.pop(key, None)
+
+_RANGE_RE = re.compile(r"(\d*)\s*(-)?\s*(\d*)")
 
 def parse_ranges(spec: str, total_pages: int) -> List[int]:
     spec = spec.strip()
     if not spec:
         raise ValueError("Empty range spec")
 
-    parts = [p.strip() for p in spec.split(",") if p.strip()]
-    pages: List[int] = []
-    seen = set()
-
-    def add_page(n1: int):
-        if 1 <= n1 <= total_pages:
-            idx = n1 - 1
-            if idx not in seen:
-                seen.add(idx)
-                pages.append(idx)
-
-    for part in parts:
-        if "-" in part:
-            a, b = part.split("-", 1)
-            a, b = a.strip(), b.strip()
-            if not a:
-                raise ValueError(f"Bad range '{part}' (missing start)")
-            start = int(a)
+    spans: List[Tuple[int, int]] = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        m = _RANGE_RE.fullmatch(part)
+        if not m:
+            raise ValueError(f"Bad range '{part}'")
+        a, dash, b = m.groups()
+        if not a:
+            raise ValueError(f"Bad range '{part}' (missing start)")
+        start = int(a)
+        if dash:
             end = total_pages if b == "" else int(b)
             if end < start:
                 raise ValueError(f"Bad range '{part}' (end < start)")
-            start = max(1, start)
-            end = min(total_pages, end)
-            for n in range(start, end + 1):
-                add_page(n)
+        elif b:
+            raise ValueError(f"Bad range '{part}'")
         else:
-            add_page(int(part))
+            end = start
+        start = max(1, start)
+        end = min(total_pages, end)
+        if start <= end:
+            spans.append((start, end))
+
+    # merge overlapping spans and expand each with range() instead of
+    # deduping page by page through a set; result is sorted, unique, 1-based
+    spans.sort()
+    pages: List[int] = []
+    last = 0
+    for start, end in spans:
+        start = max(start, last + 1)
+        if start <= end:
+            pages.extend(range(start, end + 1))
+            last = end
 
     if not pages:
         raise ValueError("No valid pages selected (maybe out of bounds?)")
     return pages
 
+def zip_files(files: List[Path], zip_path: Path) -> None:
+    # PNGs are already deflated; storing them skips a useless zlib pass
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as zf:
+        for p in files:
+            zf.write(p, arcname=p.name)
+
+def archive_files(files: List[Path], base: Path) -> Path:
+    # streamed tar + fast zstd; stored zip when zstandard isn't installed
+    if zstandard is None:
+        out = base.with_name(base.name + ".zip")
+        zip_files(files, out)
+        return out
+    out = base.with_name(base.name + ".tar.zst")
+    with open(out, "wb") as fh, \
+            zstandard.ZstdCompressor(level=1).stream_writer(fh) as zw, \
+            tarfile.open(fileobj=zw, mode="w|") as tar:
+        for p in files:
+            tar.add(p, arcname=p.name)
+    return out
+
+async def media_documents(files: List[Path]) -> List[InputMediaDocument]:
+    # read all files in parallel threads rather than one by one on the loop
+    blobs = await asyncio.gather(*[asyncio.to_thread(p.read_bytes) for p in files])
+    return [
+        InputMediaDocument(media=BufferedInputFile(b, filename=p.name))
+        for p, b in zip(files, blobs)
+    ]
+
+def split_pages(total_pages: int, parts: int) -> List[Tuple[int, int]]:
+    # contiguous 1-based (first, last) windows covering 1..total_pages
+    if total_pages < 1:
+        return []
+    parts = max(1, min(parts, total_pages))
+    k = -(-total_pages // parts)
+    return [(a, min(a + k - 1, total_pages)) for a in range(1, total_pages + 1, k)]
+
 def pages_to_compact_ranges(pages_1_based_sorted: List[int]) -> str:
     if not pages_1_based_sorted:
         return ""
@@ -210,31 +414,39 @@ def pages_to_compact_ranges(pages_1_based_sorted: List[int]) -> str:
 # =========================
 # PDF OPS
 # =========================
-def merge_pdfs(inputs: List[Path], out: Path) -> None:
+async def merge_pdfs(inputs: Sequence[Path], out: Path) -> None:
     cmd = ["qpdf", "--empty", "--pages"] + [str(p) for p in inputs] + ["--", str(out)]
-    run_cmd(cmd)
-
-def extract_pages(src: Path, pages_0_based: List[int], out: Path) -> None:
-    page_nums = [str(i + 1) for i in pages_0_based]
-    cmd = ["qpdf", str(src), "--pages", str(src)] + page_nums + ["--", str(out)]
-    run_cmd(cmd)
-
-def pdf_to_images(src: Path, out_dir: Path, dpi: int = 150) -> List[Path]:
+    await run_cmd(cmd)
+    forget_pdfs(out.parent)
+
+async def extract_pages(src: Path, pages_1_based_sorted: List[int], out: Path) -> str:
+    # one compact "1-5,8,10-20" argument instead of one argv entry per page
+    spec = pages_to_compact_ranges(pages_1_based_sorted)
+    cmd = ["qpdf", str(src), "--pages", str(src), spec, "--", str(out)]
+    await run_cmd(cmd)
+    forget_pdfs(out.parent)
+    return spec
+
+async def pdf_to_images(src: Path, out_dir: Path, dpi: int = 150) -> List[Path]:
     out_dir.mkdir(parents=True, exist_ok=True)
     prefix = out_dir / "page"
-    cmd = ["pdftoppm", "-png", "-r", str(dpi), str(src), str(prefix)]
-    run_cmd(cmd)
+    total = await pdf_page_count(src)
+    # pdftoppm is single-threaded: render disjoint page windows in parallel.
+    # Output names are padded by the document's page count, so shards agree.
+    await run_cmds([
+        ["pdftoppm", "-png", "-r", str(dpi), "-f", str(a), "-l", str(b), str(src), str(prefix)]
+        for a, b in split_pages(total, CPU_COUNT)
+    ])
     imgs = sorted(out_dir.glob("page-*.png"))
     if not imgs:
         raise RuntimeError("No images produced")
     return imgs
 
-def compress_pdf(src: Path, out: Path, preset: str) -> None:
+async def compress_pdf(src: Path, out: Path, preset: str) -> None:
     if preset not in {"screen", "ebook", "printer", "prepress"}:
         raise ValueError("preset must be one of: screen, ebook, printer, prepress")
 
-    tmp = out.with_suffix(".tmp.pdf")
-    cmd = [
+    gs_cmd = [
         "gs",
         "-sDEVICE=pdfwrite",
         "-dCompatibilityLevel=1.4",
@@ -245,12 +457,49 @@ def compress_pdf(src: Path, out: Path, preset: str) -> None:
         "-dDownsampleColorImages=true",
         "-dDownsampleGrayImages=true",
         "-dDownsampleMonoImages=true",
-        "-sOutputFile=" + str(tmp),
-        str(src),
     ]
-    run_cmd(cmd)
-    run_cmd(["qpdf", "--linearize", str(tmp), str(out)])
-    tmp.unlink(missing_ok=True)
+    # pdfwrite is single-threaded: compress page windows in parallel, then stitch.
+    # Tradeoff: bookmarks/links crossing windows are lost and resources shared
+    # across windows are embedded once per part; COMPRESS_PARALLEL=0 opts out.
+    total = await pdf_page_count(src)
+    if total < 1:
+        raise RuntimeError("PDF has no pages")
+    workers = min(CPU_COUNT, -(-total // COMPRESS_CHUNK_PAGES)) if COMPRESS_PARALLEL else 1
+    chunks = split_pages(total, workers)
+    if len(chunks) == 1 and GS_LINEARIZE:
+        # gs linearizes in the same pass, no qpdf rewrite of the whole file
+        await run_cmd(gs_cmd + ["-dFastWebView=true", "-sOutputFile=" + str(out), str(src)])
+        forget_pdfs(out.parent)
+        return
+
+    with tempfile.TemporaryDirectory(prefix=".compress_", dir=out.parent) as tmp_dir:
+        parts = [Path(tmp_dir) / f"part_{i}.pdf" for i in range(len(chunks))]
+        await run_cmds([
+            gs_cmd + [
+                f"-dFirstPage={a}",
+                f"-dLastPage={b}",
+                "-sOutputFile=" + str(part),
+                str(src),
+            ]
+            for (a, b), part in zip(chunks, parts)
+        ])
+        cmd = ["qpdf", "--linearize", str(parts[0])]
+        if len(parts) > 1:
+            cmd += ["--pages"] + [str(p) for p in parts] + ["--"]
+        await run_cmd(cmd + [str(out)])
+    forget_pdfs(out.parent)
+
+async def admit(message: Message) -> Optional[asyncio.Lock]:
+    # back-pressure for heavy jobs: None (after replying) if the host is
+    # overloaded or the user already has a job running
+    if server_busy():
+        await message.answer(BUSY_TEXT, reply_markup=menu_kb())
+        return None
+    lock = user_lock(message.from_user.id)
+    if lock.locked():
+        await message.answer(RUNNING_TEXT, reply_markup=menu_kb())
+        return None
+    return lock
 
 # =========================
 # COMMANDS
@@ -259,34 +508,43 @@ def compress_pdf(src: Path, out: Path, preset: str) -> None:
 async def start(message: Message):
     if not check_allowed(message):
         return
-    d = user_dir(message.from_user.id)
-    touch_session(d)
+    user_dir(message.from_user.id)
+    touch_session(message.from_user.id)
     await message.answer(HELP_TEXT, reply_markup=menu_kb())
 
 @dp.message(Command("help"))
 async def help_cmd(message: Message):
     if not check_allowed(message):
         return
-    d = user_dir(message.from_user.id)
-    touch_session(d)
+    user_dir(message.from_user.id)
+    touch_session(message.from_user.id)
     await message.answer(HELP_TEXT, reply_markup=menu_kb())
 
 @dp.message(Command("clear"))
-async def clear_cmd(message: Message):
+async def clear_cmd(message: Message, state: FSMContext):
     if not check_allowed(message):
         return
     user_id = message.from_user.id
     d = user_dir(user_id)
-    touch_session(d)
-    PENDING.pop(user_id, None)
+    touch_session(message.from_user.id)
 
-    for p in d.iterdir():
-        if p.name == ".last":
-            continue
-        if p.is_dir():
-            shutil.rmtree(p, ignore_errors=True)
-        else:
-            p.unlink(missing_ok=True)
+    # don't pull files out from under a running gs/pdftoppm/qpdf job
+    lock = user_lock(user_id)
+    if lock.locked():
+        await message.answer(RUNNING_TEXT, reply_markup=menu_kb())
+        return
+    async with lock:
+        await state.clear()
+        forget_page_counts(d)
+
+        for p in d.iterdir():
+            if p.name == ".last":  # legacy timestamp file, see session_last
+                continue
+            if p.is_dir():
+                shutil.rmtree(p, ignore_errors=True)
+            else:
+                p.unlink(missing_ok=True)
+        forget_pdfs(d)
 
     await message.answer("Cleared your session files.", reply_markup=menu_kb())
 
@@ -295,8 +553,7 @@ async def list_cmd(message: Message):
     if not check_allowed(message):
         return
     d = user_dir(message.from_user.id)
-    touch_session(d)
-    cleanup_old_sessions()
+    touch_session(message.from_user.id)
 
     pdfs = list_pdfs(d)
     if not pdfs:
@@ -314,30 +571,32 @@ async def merge_cmd(message: Message):
     if not check_allowed(message):
         return
     d = user_dir(message.from_user.id)
-    touch_session(d)
-    cleanup_old_sessions()
+    touch_session(message.from_user.id)
 
     pdfs = list_pdfs(d)
     if len(pdfs) < 2:
         await message.answer("Upload at least 2 PDFs, then merge.", reply_markup=menu_kb())
         return
 
-    out = d / "merged.pdf"
-    try:
-        merge_pdfs(pdfs, out)
-    except Exception as e:
-        await message.answer(f"Merge failed:\n{e}", reply_markup=menu_kb())
+    lock = await admit(message)
+    if lock is None:
         return
+    async with lock:
+        out = d / "merged.pdf"
+        try:
+            await merge_pdfs(pdfs, out)
+        except Exception as e:
+            await message.answer(f"Merge failed:\n{e}", reply_markup=menu_kb())
+            return
 
-    await message.answer_document(FSInputFile(out), caption="Merged PDF", reply_markup=menu_kb())
+        await message.answer_document(FSInputFile(out), caption="Merged PDF", reply_markup=menu_kb())
 
 @dp.message(Command("extract"))
 async def extract_cmd(message: Message):
     if not check_allowed(message):
         return
     d = user_dir(message.from_user.id)
-    touch_session(d)
-    cleanup_old_sessions()
+    touch_session(message.from_user.id)
 
     args = (message.text or "").split(maxsplit=2)
     if len(args) < 3:
@@ -352,36 +611,37 @@ async def extract_cmd(message: Message):
         await message.answer("Bad file_index. Use /list.", reply_markup=menu_kb())
         return
 
-    src = pdfs[idx - 1]
-    try:
-        total = pdf_page_count(src)
-        pages0 = parse_ranges(ranges, total)
-        pages1 = sorted({p + 1 for p in pages0})
-        compact = pages_to_compact_ranges(pages1)
+    lock = await admit(message)
+    if lock is None:
+        return
+    async with lock:
+        src = pdfs[idx - 1]
+        try:
+            total = await pdf_page_count(src)
+            pages = parse_ranges(ranges, total)
 
-        out = d / f"extract_{src.stem}_{safe_name(ranges)}.pdf"
-        extract_pages(src, pages0, out)
+            out = d / f"extract_{src.stem}_{safe_name(ranges)}.pdf"
+            compact = await extract_pages(src, pages, out)
 
-        await message.answer(
-            "Extract result:\n"
-            f"- Source: {src.name}\n"
-            f"- Total pages: {total}\n"
-            f"- Requested: {ranges}\n"
-            f"- Resolved pages ({len(pages1)}): {compact}\n"
-            f"- Output: {out.name}",
-            reply_markup=menu_kb(),
-        )
-        await message.answer_document(FSInputFile(out), caption="Extracted PDF", reply_markup=menu_kb())
-    except Exception as e:
-        await message.answer(f"Extract failed:\n{e}", reply_markup=menu_kb())
+            await message.answer(
+                "Extract result:\n"
+                f"- Source: {src.name}\n"
+                f"- Total pages: {total}\n"
+                f"- Requested: {ranges}\n"
+                f"- Resolved pages ({len(pages)}): {compact}\n"
+                f"- Output: {out.name}",
+                reply_markup=menu_kb(),
+            )
+            await message.answer_document(FSInputFile(out), caption="Extracted PDF", reply_markup=menu_kb())
+        except Exception as e:
+            await message.answer(f"Extract failed:\n{e}", reply_markup=menu_kb())
 
 @dp.message(Command("images"))
 async def images_cmd(message: Message):
     if not check_allowed(message):
         return
     d = user_dir(message.from_user.id)
-    touch_session(d)
-    cleanup_old_sessions()
+    touch_session(message.from_user.id)
 
     args = (message.text or "").split()
     if len(args) < 2:
@@ -397,39 +657,39 @@ async def images_cmd(message: Message):
         await message.answer("Bad file_index. Use /list.", reply_markup=menu_kb())
         return
 
-    src = pdfs[idx - 1]
-    out_dir = d / f"images_{src.stem}_{dpi}dpi"
-    if out_dir.exists():
-        shutil.rmtree(out_dir, ignore_errors=True)
+    lock = await admit(message)
+    if lock is None:
+        return
+    async with lock:
+        src = pdfs[idx - 1]
+        out_dir = d / f"images_{src.stem}_{dpi}dpi"
+        if out_dir.exists():
+            await asyncio.to_thread(shutil.rmtree, out_dir, ignore_errors=True)
 
-    try:
-        imgs = pdf_to_images(src, out_dir, dpi=dpi)
-        n = len(imgs)
+        try:
+            imgs = await pdf_to_images(src, out_dir, dpi=dpi)
+            n = len(imgs)
 
-        if n <= 10:
-            await message.answer(f"Sending {n} images as documents (no compression).", reply_markup=menu_kb())
-            media = [InputMediaDocument(media=FSInputFile(p)) for p in imgs]
-            await message.bot.send_media_group(chat_id=message.chat.id, media=media)
-        else:
-            zip_path = d / f"{out_dir.name}.zip"
-            if zip_path.exists():
-                zip_path.unlink(missing_ok=True)
-            shutil.make_archive(str(zip_path.with_suffix("")), "zip", out_dir)
-            await message.answer_document(
-                FSInputFile(zip_path),
-                caption=f"Images for {src.name} ({dpi} dpi) — {n} pages (zipped).",
-                reply_markup=menu_kb(),
-            )
-    except Exception as e:
-        await message.answer(f"Convert failed:\n{e}", reply_markup=menu_kb())
+            if n <= 10:
+                await message.answer(f"Sending {n} images as documents (no compression).", reply_markup=menu_kb())
+                media = await media_documents(imgs)
+                await message.bot.send_media_group(chat_id=message.chat.id, media=media)
+            else:
+                archive = await asyncio.to_thread(archive_files, imgs, d / out_dir.name)
+                await message.answer_document(
+                    FSInputFile(archive),
+                    caption=f"Images for {src.name} ({dpi} dpi) — {n} pages (archived).",
+                    reply_markup=menu_kb(),
+                )
+        except Exception as e:
+            await message.answer(f"Convert failed:\n{e}", reply_markup=menu_kb())
 
 @dp.message(Command("compress"))
 async def compress_cmd(message: Message):
     if not check_allowed(message):
         return
     d = user_dir(message.from_user.id)
-    touch_session(d)
-    cleanup_old_sessions()
+    touch_session(message.from_user.id)
 
     args = (message.text or "").split()
     if len(args) != 3:
@@ -444,21 +704,25 @@ async def compress_cmd(message: Message):
         await message.answer("Bad file_index. Use /list.", reply_markup=menu_kb())
         return
 
-    src = pdfs[idx - 1]
-    out = d / f"compressed_{preset}_{src.name}"
+    lock = await admit(message)
+    if lock is None:
+        return
+    async with lock:
+        src = pdfs[idx - 1]
+        out = d / f"compressed_{preset}_{src.name}"
 
-    try:
-        compress_pdf(src, out, preset=preset)
-        before = src.stat().st_size
-        after = out.stat().st_size
-        ratio = (after / before) if before else 1.0
-        await message.answer_document(
-            FSInputFile(out),
-            caption=f"Compressed ({preset}). Size: {before/1e6:.1f}MB → {after/1e6:.1f}MB ({ratio:.2f}x)",
-            reply_markup=menu_kb(),
-        )
-    except Exception as e:
-        await message.answer(f"Compress failed:\n{e}", reply_markup=menu_kb())
+        try:
+            await compress_pdf(src, out, preset=preset)
+            before = src.stat().st_size
+            after = out.stat().st_size
+            ratio = (after / before) if before else 1.0
+            await message.answer_document(
+                FSInputFile(out),
+                caption=f"Compressed ({preset}). Size: {before/1e6:.1f}MB → {after/1e6:.1f}MB ({ratio:.2f}x)",
+                reply_markup=menu_kb(),
+            )
+        except Exception as e:
+            await message.answer(f"Compress failed:\n{e}", reply_markup=menu_kb())
 
 # =========================
 # FILE UPLOAD
@@ -478,25 +742,30 @@ async def on_document(message: Message, bot: Bot):
         return
 
     d = user_dir(message.from_user.id)
-    touch_session(d)
+    touch_session(message.from_user.id)
 
     fname = safe_name(doc.file_name)
     target = d / fname
-    if target.exists():
+    existing = {e.name for e in os.scandir(d)}  # one scan instead of a stat per probe
+    if fname in existing:
         stem, suf = target.stem, target.suffix
         k = 2
-        while True:
-            cand = d / f"{stem}_{k}{suf}"
-            if not cand.exists():
-                target = cand
-                break
+        while f"{stem}_{k}{suf}" in existing:
             k += 1
+        target = d / f"{stem}_{k}{suf}"
 
-    file = await bot.get_file(doc.file_id)
-    data = await bot.download_file(file.file_path)
-
-    async with aiofiles.open(target, "wb") as f:
-        await f.write(data.read())
+    # streams to disk chunk by chunk instead of buffering the whole file;
+    # each chunk is one executor hop inside aiogram, so keep chunks large.
+    # The hidden .part name keeps partial downloads out of list_pdfs.
+    part = d / f".{target.name}.part"
+    try:
+        await bot.download(
+            doc, destination=part, timeout=DOWNLOAD_TIMEOUT, chunk_size=DOWNLOAD_CHUNK
+        )
+        part.replace(target)
+    finally:
+        part.unlink(missing_ok=True)
+    forget_pdfs(d)
 
     await message.answer(f"Saved: {target.name}", reply_markup=menu_kb())
 
@@ -514,28 +783,27 @@ async def btn_list(message: Message):
     await list_cmd(message)
 
 @dp.message(F.text == BTN_CLEAR)
-async def btn_clear(message: Message):
-    await clear_cmd(message)
+async def btn_clear(message: Message, state: FSMContext):
+    await clear_cmd(message, state)
 
 @dp.message(F.text == BTN_MERGE)
 async def btn_merge(message: Message):
     await merge_cmd(message)
 
 @dp.message(F.text == BTN_CANCEL)
-async def btn_cancel(message: Message):
+async def btn_cancel(message: Message, state: FSMContext):
     if not check_allowed(message):
         return
-    PENDING.pop(message.from_user.id, None)
+    await state.clear()
     await message.answer("Cancelled.", reply_markup=menu_kb())
 
 @dp.message(F.text.in_({BTN_EXTRACT, BTN_IMAGES, BTN_COMPRESS}))
-async def btn_action(message: Message):
+async def btn_action(message: Message, state: FSMContext):
     if not check_allowed(message):
         return
 
     d = user_dir(message.from_user.id)
-    touch_session(d)
-    cleanup_old_sessions()
+    touch_session(message.from_user.id)
 
     pdfs = list_pdfs(d)
     if not pdfs:
@@ -548,155 +816,165 @@ async def btn_action(message: Message):
         BTN_COMPRESS: "compress",
     }[message.text]
 
-    PENDING[message.from_user.id] = (action, 1, {})
+    await state.set_state(Flow.choose_file)
+    await state.set_data({"action": action})
     await message.answer(
         "Send file index (number from /list).\n"
         "Example: 1",
         reply_markup=menu_kb(),
     )
 
-@dp.message(F.text)
-async def pending_flow(message: Message):
-    # handles interactive steps: file index then param
+@dp.message(StateFilter(Flow.choose_file), F.text)
+async def flow_choose_file(message: Message, state: FSMContext):
+    # interactive step 1: file index
     if not check_allowed(message):
         return
 
-    user_id = message.from_user.id
-    if user_id not in PENDING:
-        return
-
-    action, step, payload = PENDING[user_id]
-    d = user_dir(user_id)
-    touch_session(d)
-    cleanup_old_sessions()
+    d = user_dir(message.from_user.id)
+    touch_session(message.from_user.id)
 
     pdfs = list_pdfs(d)
     if not pdfs:
-        PENDING.pop(user_id, None)
+        await state.clear()
         await message.answer("No PDFs uploaded.", reply_markup=menu_kb())
         return
 
     txt = (message.text or "").strip()
-
-    # step 1: choose file
-    if step == 1:
-        try:
-            idx = int(txt)
-        except Exception:
-            await message.answer("Send a number (file index from /list).", reply_markup=menu_kb())
-            return
-
-        if idx < 1 or idx > len(pdfs):
-            await message.answer("Invalid index. Use /list.", reply_markup=menu_kb())
-            return
-
-        payload["idx"] = idx
-        payload["src"] = str(pdfs[idx - 1])
-        PENDING[user_id] = (action, 2, payload)
-
-        src = Path(payload["src"])
-        if action == "extract":
-            await message.answer(
-                f"Send ranges to extract from:\n{src.name}\nExamples: 2-4,5,6-10 or 2-",
-                reply_markup=menu_kb(),
-            )
-        elif action == "images":
-            await message.answer(
-                f"Send DPI (72..400) or 'ok' for default 150.\nSource: {src.name}",
-                reply_markup=menu_kb(),
-            )
-        else:
-            await message.answer(
-                f"Send preset: screen | ebook | printer | prepress\nSource: {src.name}",
-                reply_markup=menu_kb(),
-            )
+    try:
+        idx = int(txt)
+    except Exception:
+        await message.answer("Send a number (file index from /list).", reply_markup=menu_kb())
         return
 
-    # step 2: execute
-    src = Path(payload["src"])
-    if not src.exists():
-        PENDING.pop(user_id, None)
-        await message.answer("Source file disappeared. Use /list.", reply_markup=menu_kb())
+    if idx < 1 or idx > len(pdfs):
+        await message.answer("Invalid index. Use /list.", reply_markup=menu_kb())
         return
 
-    try:
-        if action == "extract":
-            ranges = txt
-            total = pdf_page_count(src)
-            pages0 = parse_ranges(ranges, total)
-            pages1 = sorted({p + 1 for p in pages0})
-            compact = pages_to_compact_ranges(pages1)
+    src = pdfs[idx - 1]
+    await state.update_data(idx=idx, src=str(src))
+    await state.set_state(Flow.param)
 
-            out = d / f"extract_{src.stem}_{safe_name(ranges)}.pdf"
-            extract_pages(src, pages0, out)
+    action = (await state.get_data())["action"]
+    if action == "extract":
+        await message.answer(
+            f"Send ranges to extract from:\n{src.name}\nExamples: 2-4,5,6-10 or 2-",
+            reply_markup=menu_kb(),
+        )
+    elif action == "images":
+        await message.answer(
+            f"Send DPI (72..400) or 'ok' for default 150.\nSource: {src.name}",
+            reply_markup=menu_kb(),
+        )
+    else:
+        await message.answer(
+            f"Send preset: screen | ebook | printer | prepress\nSource: {src.name}",
+            reply_markup=menu_kb(),
+        )
 
-            await message.answer(
-                "Extract result:\n"
-                f"- Source: {src.name}\n"
-                f"- Total pages: {total}\n"
-                f"- Requested: {ranges}\n"
-                f"- Resolved pages ({len(pages1)}): {compact}\n"
-                f"- Output: {out.name}",
-                reply_markup=menu_kb(),
-            )
-            await message.answer_document(FSInputFile(out), caption="Extracted PDF", reply_markup=menu_kb())
+@dp.message(StateFilter(Flow.param), F.text)
+async def flow_param(message: Message, state: FSMContext):
+    # interactive step 2: param, then execute
+    if not check_allowed(message):
+        return
 
-        elif action == "images":
-            dpi = 150
-            if txt.lower() != "ok":
-                dpi = int(txt)
-                dpi = max(72, min(dpi, 400))
+    user_id = message.from_user.id
+    d = user_dir(user_id)
+    touch_session(user_id)
 
-            out_dir = d / f"images_{src.stem}_{dpi}dpi"
-            if out_dir.exists():
-                shutil.rmtree(out_dir, ignore_errors=True)
+    data = await state.get_data()
+    action = data["action"]
+    src = Path(data["src"])
+    txt = (message.text or "").strip()
 
-            imgs = pdf_to_images(src, out_dir, dpi=dpi)
-            n = len(imgs)
+    if not src.exists():
+        await state.clear()
+        await message.answer("Source file disappeared. Use /list.", reply_markup=menu_kb())
+        return
 
-            if n <= 10:
-                await message.answer(f"Sending {n} images as documents (no compression).", reply_markup=menu_kb())
-                media = [InputMediaDocument(media=FSInputFile(p)) for p in imgs]
-                await message.bot.send_media_group(chat_id=message.chat.id, media=media)
-            else:
-                zip_path = d / f"{out_dir.name}.zip"
-                if zip_path.exists():
-                    zip_path.unlink(missing_ok=True)
-                shutil.make_archive(str(zip_path.with_suffix("")), "zip", out_dir)
+    # on refusal the state is kept so the user can just resend the parameter
+    lock = await admit(message)
+    if lock is None:
+        return
+    async with lock:
+        try:
+            if action == "extract":
+                ranges = txt
+                total = await pdf_page_count(src)
+                pages = parse_ranges(ranges, total)
+
+                out = d / f"extract_{src.stem}_{safe_name(ranges)}.pdf"
+                compact = await extract_pages(src, pages, out)
+
+                await message.answer(
+                    "Extract result:\n"
+                    f"- Source: {src.name}\n"
+                    f"- Total pages: {total}\n"
+                    f"- Requested: {ranges}\n"
+                    f"- Resolved pages ({len(pages)}): {compact}\n"
+                    f"- Output: {out.name}",
+                    reply_markup=menu_kb(),
+                )
+                await message.answer_document(FSInputFile(out), caption="Extracted PDF", reply_markup=menu_kb())
+
+            elif action == "images":
+                dpi = 150
+                if txt.lower() != "ok":
+                    dpi = int(txt)
+                    dpi = max(72, min(dpi, 400))
+
+                out_dir = d / f"images_{src.stem}_{dpi}dpi"
+                if out_dir.exists():
+                    await asyncio.to_thread(shutil.rmtree, out_dir, ignore_errors=True)
+
+                imgs = await pdf_to_images(src, out_dir, dpi=dpi)
+                n = len(imgs)
+
+                if n <= 10:
+                    await message.answer(f"Sending {n} images as documents (no compression).", reply_markup=menu_kb())
+                    media = await media_documents(imgs)
+                    await message.bot.send_media_group(chat_id=message.chat.id, media=media)
+                else:
+                    archive = await asyncio.to_thread(archive_files, imgs, d / out_dir.name)
+                    await message.answer_document(
+                        FSInputFile(archive),
+                        caption=f"Images for {src.name} ({dpi} dpi) — {n} pages (archived).",
+                        reply_markup=menu_kb(),
+                    )
+
+            else:  # compress
+                preset = txt.lower()
+                if preset not in {"screen", "ebook", "printer", "prepress"}:
+                    raise ValueError("Bad preset. Use: screen | ebook | printer | prepress")
+
+                out = d / f"compressed_{preset}_{src.name}"
+                await compress_pdf(src, out, preset=preset)
+
+                before = src.stat().st_size
+                after = out.stat().st_size
+                ratio = (after / before) if before else 1.0
                 await message.answer_document(
-                    FSInputFile(zip_path),
-                    caption=f"Images for {src.name} ({dpi} dpi) — {n} pages (zipped).",
+                    FSInputFile(out),
+                    caption=f"Compressed ({preset}). Size: {before/1e6:.1f}MB → {after/1e6:.1f}MB ({ratio:.2f}x)",
                     reply_markup=menu_kb(),
                 )
 
-        else:  # compress
-            preset = txt.lower()
-            if preset not in {"screen", "ebook", "printer", "prepress"}:
-                raise ValueError("Bad preset. Use: screen | ebook | printer | prepress")
-
-            out = d / f"compressed_{preset}_{src.name}"
-            compress_pdf(src, out, preset=preset)
-
-            before = src.stat().st_size
-            after = out.stat().st_size
-            ratio = (after / before) if before else 1.0
-            await message.answer_document(
-                FSInputFile(out),
-                caption=f"Compressed ({preset}). Size: {before/1e6:.1f}MB → {after/1e6:.1f}MB ({ratio:.2f}x)",
-                reply_markup=menu_kb(),
-            )
-
-    except Exception as e:
-        await message.answer(f"Failed:\n{e}", reply_markup=menu_kb())
-    finally:
-        PENDING.pop(user_id, None)
+        except Exception as e:
+            await message.answer(f"Failed:\n{e}", reply_markup=menu_kb())
+        finally:
+            await state.clear()
 
 # =========================
 # MAIN
 # =========================
 async def main():
     bot = Bot(BOT_TOKEN)
-    await dp.start_polling(bot)
+    load_sessions()
+    gc_task = asyncio.create_task(gc_loop())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        gc_task.cancel()
+        save_sessions(dict(_SESSION_LAST))
 
 if __name__ == "__main__":
     asyncio.run(main())